@@ -1,11 +1,12 @@
 """Plotly bargraph functionality."""
-import copy
 import dataclasses
+import functools
+import itertools
 import logging
-from collections import defaultdict
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
 
 import math
+import numpy as np
 import plotly.graph_objects as go
 import spectra
 
@@ -43,6 +44,79 @@ def plot(
     return p.add_to_report(report)
 
 
+@functools.lru_cache(maxsize=1024)
+def _color_to_rgb_str(color: str) -> str:
+    """
+    Convert a HTML color to a "r,g,b" string with each component scaled to 0-1. Colors are
+    typically re-used from a palette, so caching saves re-parsing them with spectra.
+    """
+    if len(color) == 7 and color.startswith("#"):
+        try:
+            rgb = [int(color[i : i + 2], 16) / 255 for i in (1, 3, 5)]
+        except ValueError:
+            rgb = spectra.html(color).rgb
+    else:
+        rgb = spectra.html(color).rgb
+    return ",".join([f"{x:.2f}" for x in rgb])
+
+
+def _signed_sums(values: np.ndarray) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    Per-sample sums of positive and negative values of a [n_cats, n_samples] matrix. NaN
+    values are skipped. Bars are typically non-negative counts, in which case the negative
+    sums are not calculated, and None is returned instead.
+    """
+    # Using fmax/fmin rather than maximum/minimum, as those don't propagate NaN values
+    pos_sums = np.fmax(values, 0).sum(axis=0)
+    neg_sums = np.fmin(values, 0).sum(axis=0) if (values < 0).any() else None
+    return pos_sums, neg_sums
+
+
+def _bar_stats(
+    values: np.ndarray,
+    is_group: bool,
+    with_pct: bool,
+) -> Tuple[float, float, Optional[np.ndarray], float]:
+    """
+    Compute the x-axis range and the percentages for a bar plot dataset.
+    :param values: [n_cats, n_samples] matrix of values, may contain NaN
+    :param is_group: whether categories are drawn side by side rather than stacked
+    :param with_pct: whether to calculate percentages as well
+    :return: (xmin, xmax) for counts; [n_cats, n_samples] matrix of percentages of
+        each category within a sample (None if with_pct is False), and xmin for percentages
+    """
+    # The per-sample sums are shared by the stacked range and the percentages, so that
+    # each of them doesn't have to make its own pass over the values
+    if is_group:
+        # max category
+        xmin = float(np.nanmin(values))
+        xmax = float(np.nanmax(values))
+        if not with_pct:
+            return xmin, xmax, None, 0.0
+        pos_sums, neg_sums = _signed_sums(values)
+    else:
+        pos_sums, neg_sums = _signed_sums(values)
+        # max sum of all categories across all samples
+        xmin = float(neg_sums.min()) if neg_sums is not None else 0.0
+        xmax = float(pos_sums.max())
+        if not with_pct:
+            return xmin, xmax, None, 0.0
+
+    # Count totals for each sample, then calculate percentages for each category
+    sums = pos_sums - neg_sums if neg_sums is not None else pos_sums
+    safe_sums = np.where(sums == 0, 1.0, sums)
+    pct = np.where(sums == 0, 0.0, values / safe_sums * 100.0)
+
+    # calculating the min percentage range as well because it will be negative for negative values
+    if is_group:
+        pct_xmin = float(np.nanmin(pct))
+    elif neg_sums is not None:
+        pct_xmin = float((neg_sums / safe_sums * 100.0).min())
+    else:
+        pct_xmin = 0.0
+    return xmin, xmax, pct, pct_xmin
+
+
 class BarPlot(Plot):
     @dataclasses.dataclass
     class Dataset(BaseDataset):
@@ -56,6 +130,7 @@ class BarPlot(Plot):
             samples: List[str],
         ) -> "BarPlot.Dataset":
             # Post-process categories
+            n_samples = len(samples)
             for cat in cats:
                 # Split long category names
                 if "name" not in cat:
@@ -63,11 +138,10 @@ class BarPlot(Plot):
                 cat["name"] = "<br>".join(split_long_string(cat["name"]))
 
                 # Reformat color to be ready to add alpha in Plotly-JS
-                color = spectra.html(cat["color"])
-                cat["color"] = ",".join([f"{x:.2f}" for x in color.rgb])
+                cat["color"] = _color_to_rgb_str(cat["color"])
 
                 # Check that the number of samples is the same for all categories
-                assert len(samples) == len(cat["data"])
+                assert n_samples == len(cat["data"])
 
             dataset = BarPlot.Dataset(
                 **dataset.__dict__,
@@ -88,12 +162,14 @@ class BarPlot(Plot):
             """
             fig = go.Figure(layout=layout)
 
+            traces = []
             for cat in self.cats:
                 data = cat["data_pct"] if is_pct else cat["data"]
 
-                params = copy.deepcopy(self.trace_params)
-                params["marker"]["color"] = f"rgb({cat['color']})"
-                fig.add_trace(
+                # Shallow copies are enough here: only the marker color differs between traces
+                marker = {**self.trace_params["marker"], "color": f"rgb({cat['color']})"}
+                params = {**self.trace_params, "marker": marker}
+                traces.append(
                     go.Bar(
                         y=self.samples,
                         x=data,
@@ -101,6 +177,8 @@ class BarPlot(Plot):
                         **params,
                     ),
                 )
+            # Adding all traces at once, so the figure validates its trace list only once
+            fig.add_traces(traces)
             return fig
 
     def __init__(self, pconfig: Dict, cats_lists: List, samples_lists: List, max_n_samples: int):
@@ -125,27 +203,20 @@ class BarPlot(Plot):
         if barmode == "group":
             n_bars *= max_n_cats
 
-        def n_bars_to_size(n: int):
-            if n >= 30:
-                return 15
-            if n >= 20:
-                return 20
-            if n >= 10:
-                return 25
-            if n >= 5:
-                return 30
-            return 35
+        # (minimal number of bars, bar size), the more bars, the thinner they are
+        BAR_SIZES = ((30, 15), (20, 20), (10, 25), (5, 30))
+        bar_size = next((size for min_n_bars, size in BAR_SIZES if n_bars >= min_n_bars), 35)
 
         # Set height to be proportional to the number of samples
-        height = n_bars * n_bars_to_size(n_bars)
+        height = n_bars * bar_size
 
         # Set height to also be proportional to the number of cats to fit a legend
         HEIGHT_PER_LEGEND_ITEM = 19
         legend_height = HEIGHT_PER_LEGEND_ITEM * max_n_cats
         # expand the plot to fit the legend:
-        height = max(height, max(height, legend_height))
+        height = max(height, legend_height)
         # but not too much - if there are only 2 samples, we don't want the plot to be too high:
-        height = min(660, max(height, legend_height))
+        height = min(660, height)
 
         height += 140  # Add space for the title and footer
 
@@ -193,41 +264,60 @@ class BarPlot(Plot):
             ),
         )
 
+        # Expand data with zeroes if there are fewer values than samples
         for dataset in self.datasets:
-            if barmode == "group":
-                # max category
-                xmax_cnt = max(max(cat["data"][i] for cat in dataset.cats) for i in range(len(dataset.samples)))
-                xmin_cnt = min(min(cat["data"][i] for cat in dataset.cats) for i in range(len(dataset.samples)))
-            else:
-                # max sum of all categories across all samples
-                xmax_cnt = max(
-                    sum(cat["data"][i] if cat["data"][i] > 0 else 0 for cat in dataset.cats)
-                    for i in range(len(dataset.samples))
-                )
-                xmin_cnt = min(
-                    sum(cat["data"][i] if cat["data"][i] < 0 else 0 for cat in dataset.cats)
-                    for i in range(len(dataset.samples))
-                )
+            n_samples = len(dataset.samples)
+            for cat in dataset.cats:
+                n_missing = n_samples - len(cat["data"])
+                if n_missing > 0:
+                    cat["data"].extend(itertools.repeat(0, n_missing))
+
+        for dataset in self.datasets:
+            # Stack categories into a [n_cats, n_samples] matrix
+            values = np.array([cat["data"] for cat in dataset.cats], dtype=float)
+            xmin_cnt, xmax_cnt, pct, pct_xmin = _bar_stats(
+                values,
+                is_group=barmode == "group",
+                with_pct=self.add_pct_tab,
+            )
+
+            # Save percentages
+            if pct is not None:
+                for cat, cat_pct in zip(dataset.cats, pct):
+                    cat["data_pct"] = cat_pct.tolist()
+                dataset.pct_range["xaxis"]["min"] = pct_xmin
+
+            if self.add_log_tab:
+                # Sorting from small to large so the log switch makes sense
+                order = np.argsort(np.nansum(values, axis=1), kind="stable")
+                dataset.cats = [dataset.cats[i] for i in order]
+                # But reversing the legend so the largest bars are still on the top
+                self.layout.legend.traceorder = "reversed"
 
+            # Swap the axes: bars are horizontal, so the sample names go on the y axis
+            xaxis = dataset.layout["xaxis"]
+            yaxis = dataset.layout["yaxis"]
             dataset.layout.update(
-                yaxis=dict(
-                    title=None,
-                    hoverformat=dataset.layout["xaxis"]["hoverformat"],
-                    ticksuffix=dataset.layout["xaxis"]["ticksuffix"],
-                    autorangeoptions=dataset.layout["xaxis"]["autorangeoptions"],
-                    # Prevent JavaScript from automatically parsing categorical values as numbers:
-                    type="category",
-                ),
-                xaxis=dict(
-                    title=dict(text=dataset.layout["yaxis"]["title"]["text"]),
-                    hoverformat=dataset.layout["yaxis"]["hoverformat"],
-                    ticksuffix=dataset.layout["yaxis"]["ticksuffix"],
-                    autorangeoptions={
-                        "minallowed": xmin_cnt,
-                        "maxallowed": xmax_cnt,
+                {
+                    "yaxis": {
+                        "title": None,
+                        "hoverformat": xaxis["hoverformat"],
+                        "ticksuffix": xaxis["ticksuffix"],
+                        "autorangeoptions": xaxis["autorangeoptions"],
+                        # Prevent JavaScript from automatically parsing categorical values as numbers:
+                        "type": "category",
                     },
-                ),
-                showlegend=len(dataset.cats) > 1,
+                    "xaxis": {
+                        "title": {"text": yaxis["title"]["text"]},
+                        "hoverformat": yaxis["hoverformat"],
+                        "ticksuffix": yaxis["ticksuffix"],
+                        "autorangeoptions": {
+                            "minallowed": xmin_cnt,
+                            "maxallowed": xmax_cnt,
+                        },
+                    },
+                    "showlegend": len(dataset.cats) > 1,
+                }
             )
             dataset.trace_params.update(
                 orientation="h",
@@ -245,51 +335,6 @@ class BarPlot(Plot):
                 elif all(all(isinstance(x, int) or math.isnan(x) for x in cat["data"]) for cat in dataset.cats):
                     dataset.layout["xaxis"]["hoverformat"] = ",.0f"
 
-        # Expand data with zeroes if there are fewer values than samples
-        for dataset in self.datasets:
-            for cat in dataset.cats:
-                if len(cat["data"]) < len(dataset.samples):
-                    cat["data"].extend([0] * (len(dataset.samples) - len(cat["data"])))
-
-        # Calculate and save percentages
-        if self.add_pct_tab:
-            for pidx, dataset in enumerate(self.datasets):
-                # Count totals for each category
-                sums = [0 for _ in dataset.cats[0]["data"]]
-                for cat in dataset.cats:
-                    for sample_idx, val in enumerate(cat["data"]):
-                        if not math.isnan(val):
-                            sums[sample_idx] += abs(val)
-
-                # Now, calculate percentages for each category
-                for cat in dataset.cats:
-                    values = [x for x in cat["data"]]
-                    for sample_idx, val in enumerate(values):
-                        sum_for_sample = sums[sample_idx]
-                        if sum_for_sample == 0:
-                            values[sample_idx] = 0
-                        else:
-                            values[sample_idx] = float(val + 0.0) / float(sum_for_sample) * 100.0
-                    cat["data_pct"] = values
-
-                if barmode == "group":
-                    # calculating the min percentage range as well because it will be negative for negative values
-                    dataset.pct_range["xaxis"]["min"] = min(
-                        min(cat["data_pct"][i] for cat in dataset.cats) for i in range(len(dataset.samples))
-                    )
-                else:
-                    dataset.pct_range["xaxis"]["min"] = min(
-                        sum(cat["data_pct"][i] if cat["data_pct"][i] < 0 else 0 for cat in dataset.cats)
-                        for i in range(len(dataset.samples))
-                    )
-
-        if self.add_log_tab:
-            # Sorting from small to large so the log switch makes sense
-            for dataset in self.datasets:
-                dataset.cats.sort(key=lambda x: sum(x["data"]))
-                # But reversing the legend so the largest bars are still on the top
-                self.layout.legend.traceorder = "reversed"
-
     @staticmethod
     def axis_controlled_by_switches() -> List[str]:
         """
@@ -299,11 +344,10 @@ class BarPlot(Plot):
         return ["xaxis"]
 
     def save_data_file(self, dataset: Dataset) -> None:
-        val_by_cat_by_sample = defaultdict(dict)
-        for cat in dataset.cats:
-            for d_idx, d_val in enumerate(cat["data"]):
-                s_name = dataset.samples[d_idx]
-                val_by_cat_by_sample[s_name][cat["name"]] = d_val
+        # Transpose the per-category lists into per-sample rows
+        cat_names = [cat["name"] for cat in dataset.cats]
+        rows = zip(*[cat["data"] for cat in dataset.cats])
+        val_by_cat_by_sample = {s_name: dict(zip(cat_names, row)) for s_name, row in zip(dataset.samples, rows)}
         util_functions.write_data_file(val_by_cat_by_sample, dataset.uid)
 
     @staticmethod